@@ -1,11 +1,35 @@
-import os
-import time
-import tempfile
-from typing import Optional, Tuple, List, Dict
+import json
+from collections import deque
+from concurrent.futures import Future
+from typing import Optional, Deque, Dict, Final, List, Tuple, Union
 
 import streamlit as st
-from google import genai
-from pypdf import PdfReader
+
+from kihs_common import (
+    BATCH_FAILED_STATES,
+    GenRequest,
+    FAST_SUMMARY_MIN_PAGES,
+    PROMPT_COMMON_RULES,
+    PROMPT_OPTIONS,
+    content_digest,
+    discard_pdf_upload,
+    fetch_batch,
+    file_part,
+    generate_cached,
+    generate_stream,
+    generate_many_cached,
+    generate_stream_cached,
+    get_client,
+    parse_pdf_cached,
+    parsed_pdf_lookup,
+    parse_pdf_excerpt_cached,
+    pdf_excerpt_lookup,
+    start_pdf_upload,
+    store_generated,
+    submit_batch,
+    trim_by_tokens,
+    trim_text,
+)
 
 
 # ============================================================
@@ -25,6 +49,7 @@ st.markdown(
 - 본 앱은 **데모**입니다. 결과는 참고용이며, 원문 근거 범위 내에서만 해석해야 합니다.
 - **API 안정성**을 위해 먼저 PDF를 로컬에서 텍스트로 추출한 뒤, 텍스트 기반으로 Gemini에 질의합니다.
 - 스캔 PDF 등 텍스트 추출이 부족한 경우에만(선택) 파일 업로드 방식으로 **fallback**합니다.
+  (업로드 대체 경로를 허용하면 처음 분석하는 PDF는 대기 시간을 줄이기 위해 파싱과 동시에 업로드를 시작하고, 텍스트가 충분하면 업로드본을 바로 삭제합니다.)
 """
 )
 
@@ -32,24 +57,7 @@ st.markdown(
 # 1) Prompt Definitions (사전 정의)
 # ============================================================
 
-PROMPT_COMMON_RULES = """
-[공통 규칙]
-- 반드시 한국어로 답변하세요.
-- 당신은 'KIHS(한국수자원조사기술원) 보고서 기반 교육/분석 튜터'입니다.
-- 문서에 없는 내용은 만들지 말고, 불확실하면 '문서에서 확인 불가'라고 명시하세요.
-- 가능한 경우, 근거가 되는 문서 표현을 1~2문장으로 요약해 함께 제시하세요(직접 인용은 1문장 이내).
-- 과장 없이 간결하고 단정한 문장으로 작성하세요.
-"""
-
-PROMPT_OPTIONS = """
-[옵션]
-- 톤: 공공기관 보고서 스타일(차분, 단정, 과장 없음) + 학습자 친화(핵심→설명→정리)
-- 독자: 수자원/물관리 분야 실무자 및 연구자(초중급 포함)
-- 금지: 홍보성 표현, 감정적 표현, 근거 없는 단정, 과도한 상상
-- 용어: 한국어 용어 우선(예: water treatment plant=정수장)
-"""
-
-PROMPT_SECTIONS_SUMMARY = """
+PROMPT_SECTIONS_SUMMARY: Final[str] = """
 [요약 리포트 출력 섹션]
 1) 핵심 요약 (6줄 이내)
 2) 연구 배경/문제정의 (bullet 3~6개)
@@ -62,22 +70,51 @@ PROMPT_SECTIONS_SUMMARY = """
 9) 다음 단계/추가 연구 질문 (3~6개)
 """
 
-PROMPT_EDU_QA_SPEC = """
+PROMPT_EDU_QA_SPEC: Final[str] = """
 [교육형 Q&A 생성 규격]
-- 총 {num_q}개 문항을 생성.
-- 형식은 아래 고정:
-
-Q1. (질문: 개념/맥락/근거 중심)
-A1. (짧은 답: 3~5줄)
-근거(문서 기반): (문서에서 확인되는 근거를 1~2문장으로 요약)
-추가 설명: (배경 설명/오해 방지 3~6줄)
-학습 체크: (예/아니오 또는 단답형 질문 1개)
-
+- 총 {num_q}개 문항을 JSON 배열로 생성. 각 문항의 필드:
+  question: 질문(개념/맥락/근거 중심)
+  answer: 짧은 답(3~5줄)
+  evidence: 문서에서 확인되는 근거(1~2문장 요약)
+  explanation: 추가 설명(배경 설명/오해 방지 3~6줄)
+  check: 학습 체크(예/아니오 또는 단답형 질문 1개)
 - 질문 유형은 섞어서 구성:
   (a) 핵심 개념 정의  (b) 왜 중요한가(맥락)  (c) 방법/데이터  (d) 결과 해석  (e) 한계/리스크  (f) 실무 적용
 """
 
-PROMPT_CHAT_SPEC = """
+# 문항 수가 많을 때만 여러 묶음으로 나눠 동시에 생성 (묶음별 출력이 짧아 전체 완료가 빨라짐)
+# - 묶음마다 문서 전체를 다시 보내므로(입력 토큰 × 묶음 수) EDU_QA_SPLIT_ABOVE 이하(기본 7문항 포함)는 한 번에 생성
+EDU_QA_SPLIT_ABOVE: Final[int] = 10
+EDU_QA_BATCH_SIZE: Final[int] = 8
+PROMPT_EDU_QA_PART: Final[str] = """
+[분할 생성]
+- 전체 문항을 {parts}개 묶음으로 나누어 생성 중이며, 이번은 {part}번째 묶음.
+- 다른 묶음과 질문이 겹치지 않도록, 문서를 {parts}등분했을 때 {part}번째 부분의 내용을 중심으로 출제.
+"""
+
+# 교육형 Q&A 구조화 출력(JSON) 스키마: 위 규격의 필드와 동일
+EDU_QA_ITEM_FIELDS: Final = ("question", "answer", "evidence", "explanation", "check")
+EDU_QA_SCHEMA: Final[dict] = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {f: {"type": "STRING"} for f in EDU_QA_ITEM_FIELDS},
+        "required": list(EDU_QA_ITEM_FIELDS),
+        "property_ordering": list(EDU_QA_ITEM_FIELDS),
+    },
+}
+EDU_QA_CONFIG: Final[dict] = {"response_mime_type": "application/json", "response_schema": EDU_QA_SCHEMA}
+
+# 요약 + Q&A 한 번에 생성: 문서를 한 번만 처리하도록 두 결과를 하나의 JSON 객체로 받음
+BOTH_SCHEMA: Final[dict] = {
+    "type": "OBJECT",
+    "properties": {"summary": {"type": "STRING"}, "edu_qa": EDU_QA_SCHEMA},
+    "required": ["summary", "edu_qa"],
+    "property_ordering": ["summary", "edu_qa"],
+}
+BOTH_CONFIG: Final[dict] = {"response_mime_type": "application/json", "response_schema": BOTH_SCHEMA}
+
+PROMPT_CHAT_SPEC: Final[str] = """
 [추가 질의(대화) 규칙]
 - 사용자의 질문에 대해, 문서 근거를 최우선으로 답변.
 - 문서에 없는 내용은 '문서에서 확인 불가'로 처리하고, 대신 확인을 위한 질문/추가자료를 제안.
@@ -88,17 +125,25 @@ PROMPT_CHAT_SPEC = """
   4) 추가 확인 질문(1~3개)
 """
 
-TASK_SUMMARY = """
+TASK_SUMMARY: Final[str] = """
 [작업]
 업로드된 KIHS 보고서(PDF)의 내용을 바탕으로, 지정된 섹션 형식에 맞춰 요약 리포트를 작성하세요.
 """
 
-TASK_EDU_QA = """
+TASK_EDU_QA: Final[str] = """
 [작업]
 업로드된 KIHS 보고서(PDF)의 내용을 바탕으로, 학습용 교육형 Q&A를 생성하세요.
 """
 
-TASK_CHAT = """
+TASK_BOTH: Final[str] = """
+[작업]
+업로드된 KIHS 보고서(PDF)의 내용을 바탕으로, 요약 리포트와 교육형 Q&A를 함께 생성하세요.
+결과는 JSON 객체로 출력:
+- summary: 지정된 섹션 형식에 맞춘 요약 리포트(Markdown 문자열)
+- edu_qa: 교육형 Q&A 생성 규격에 맞춘 문항 배열
+"""
+
+TASK_CHAT: Final[str] = """
 [작업]
 아래 사용자의 추가 질문에 대해, 문서 근거 중심으로 답하세요.
 """
@@ -122,143 +167,226 @@ if not api_key:
     st.stop()
 
 try:
-    client = genai.Client(api_key=api_key)
+    client = get_client(api_key)
 except Exception as e:
     st.error("Gemini Client 초기화 실패")
     st.exception(e)
     st.stop()
 
 # ============================================================
-# 3) PDF Parsing (Primary path for stability)
+# 3) Gemini File Upload Fallback (UI)
 # ============================================================
-def extract_text_from_pdf(uploaded_file) -> Tuple[str, int]:
-    reader = PdfReader(uploaded_file)
-    n_pages = len(reader.pages)
-
-    parts = []
-    for i in range(n_pages):
-        try:
-            t = reader.pages[i].extract_text() or ""
-        except Exception:
-            t = ""
-        t = t.strip()
-        if t:
-            parts.append(f"[PAGE {i+1}]\n{t}")
-
-    return "\n\n".join(parts).strip(), n_pages
-
-
-def normalize_text(text: str) -> str:
-    t = (text or "").replace("\r", "\n")
-    while "\n\n\n" in t:
-        t = t.replace("\n\n\n", "\n\n")
-    return t.strip()
+def wait_pdf_upload(fut: Future) -> Optional[object]:
+    try:
+        with st.spinner("Gemini 서버로 PDF 업로드 중(대체 경로)..."):
+            return fut.result()
+    except Exception as e:
+        st.error("파일 업로드 중 오류가 발생했습니다.")
+        st.exception(e)
+        return None
 
 
-def trim_text(text: str, max_chars: int) -> str:
-    if len(text) <= max_chars:
-        return text
-    return text[:max_chars] + "\n\n[...입력 길이 제한으로 일부 생략됨...]"
+# 백그라운드 업로드가 있으면 결과를 받아 file_uri로 확정 (이미 끝났으면 대기 없이 반환)
+# - 업로드가 필요한 버튼 처리 시점까지 대기를 미뤄, 사용자가 화면을 보는 동안 업로드가 진행됨
+def resolve_file_uri() -> Optional[str]:
+    pending = st.session_state.upload_pending
+    if pending is not None:
+        digest, fut = pending
+        st.session_state.upload_pending = None
+        file_ref = wait_pdf_upload(fut)
+        if file_ref is not None:
+            st.session_state.file_uris[digest] = file_ref.uri
+            st.session_state.file_uri = file_ref.uri
+    return st.session_state.file_uri
 
 
-# ============================================================
-# 4) Gemini File Upload Fallback (optional)
-# ============================================================
-def upload_pdf_to_gemini_file_api(client, uploaded_file) -> Optional[object]:
-    tmp_path = None
+# 교육형 Q&A(JSON) 표시: 파싱 실패 시(차단/잘린 응답 등) 원문 그대로 표시
+def render_edu_qa(text: str) -> None:
+    try:
+        items = json.loads(text)
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        st.markdown(text)
+        return
+    for i, item in enumerate(items, 1):
+        st.markdown(f"**Q{i}. {item.get('question', '')}**")
+        st.markdown(f"**A{i}.** {item.get('answer', '')}")
+        with st.expander(f"Q{i} 근거 · 추가 설명 · 학습 체크"):
+            st.markdown(f"**근거(문서 기반):** {item.get('evidence', '')}")
+            st.markdown(f"**추가 설명:** {item.get('explanation', '')}")
+            st.markdown(f"**학습 체크:** {item.get('check', '')}")
+
+
+# 교육형 Q&A 문항 배열 검사: 각 문항이 규격의 필드를 모두 문자열로 가져야 함 (아니면 ValueError)
+def _check_edu_qa_items(items) -> list:
+    if not isinstance(items, list):
+        raise ValueError("edu_qa is not an array")
+    for item in items:
+        if not isinstance(item, dict) or not all(isinstance(item.get(f), str) for f in EDU_QA_ITEM_FIELDS):
+            raise ValueError("unexpected edu_qa item")
+    return items
+
+
+# 캐시 저장 전 검사용 (형식이 맞는 Q&A 응답만 캐시)
+def is_edu_qa_output(text: str) -> bool:
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(uploaded_file.getvalue())
-            tmp_path = tmp.name
+        _check_edu_qa_items(json.loads(text))
+    except ValueError:
+        return False
+    return True
+
+
+# 요약 + Q&A 통합 응답(JSON) → (요약 Markdown, Q&A JSON 문자열)
+# - 형식이 다르면 json.JSONDecodeError(ValueError) / KeyError / ValueError
+def _parse_both_output(text: str) -> Tuple[str, str]:
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError("both output is not an object")
+    summary, edu_qa = data["summary"], _check_edu_qa_items(data["edu_qa"])
+    if not isinstance(summary, str):
+        raise ValueError("unexpected both output summary")
+    return summary, json.dumps(edu_qa, ensure_ascii=False)
+
+
+# 캐시 저장 전 검사용 (형식이 맞는 통합 응답만 캐시)
+def is_both_output(text: str) -> bool:
+    try:
+        _parse_both_output(text)
+    except (ValueError, KeyError):
+        return False
+    return True
 
-        with st.spinner("Gemini 서버로 PDF 업로드 중(대체 경로)..."):
-            file_ref = client.files.upload(path=tmp_path)
 
-        return file_ref
-    except Exception as e:
-        st.error("파일 업로드 중 오류가 발생했습니다.")
-        st.exception(e)
+def split_both_output(text: str) -> Optional[Tuple[str, str]]:
+    try:
+        return _parse_both_output(text)
+    except (ValueError, KeyError):
+        st.error("요약 + Q&A 통합 응답의 형식이 올바르지 않습니다. 다시 시도하거나 개별 생성 버튼을 사용하세요.")
         return None
-    finally:
-        try:
-            if tmp_path and os.path.exists(tmp_path):
-                os.remove(tmp_path)
-        except Exception:
-            pass
 
 
-# ============================================================
-# 5) Gemini Call Wrapper (minimal retry)
-# ============================================================
-def generate_with_retry(model: str, contents, retries: int = 1, sleep_s: float = 0.6) -> str:
-    last_err = None
-    for attempt in range(retries + 1):
+# 분할 생성한 교육형 Q&A(JSON 배열들 또는 묶음별 예외) → 하나의 JSON 배열
+# - 실패했거나 형식이 맞지 않는 묶음은 묶음별로 경고하고 나머지 문항만 사용 (캐시되지 않으므로 다음 요청에서 재생성)
+# - 사용할 문항이 하나도 없으면 예외 발생 (생성 실패가 있으면 그 첫 예외)
+def merge_edu_qa(parts: List[Union[str, Exception]]) -> str:
+    if len(parts) == 1:
+        if isinstance(parts[0], Exception):
+            raise parts[0]
+        return parts[0]
+    items = []
+    errors: List[Exception] = []
+    for n, p in enumerate(parts, 1):
+        if isinstance(p, Exception):
+            errors.append(p)
+            st.warning(f"교육형 Q&A {n}/{len(parts)}번째 묶음 생성에 실패해 제외했습니다: {p}")
+            continue
         try:
-            resp = client.models.generate_content(model=model, contents=contents)
-            return resp.text or ""
-        except Exception as e:
-            last_err = e
-            if attempt < retries:
-                time.sleep(sleep_s)
-    raise last_err
+            items.extend(_check_edu_qa_items(json.loads(p)))
+        except ValueError:
+            st.warning(f"교육형 Q&A {n}/{len(parts)}번째 묶음의 응답 형식이 올바르지 않아 제외했습니다.")
+    if not items:
+        if errors:
+            raise errors[0]
+        raise ValueError("교육형 Q&A 응답이 모두 올바른 JSON 형식이 아닙니다. 다시 시도해 주세요.")
+    return json.dumps(items, ensure_ascii=False)
 
 
 # ============================================================
-# 6) Build Prompts
+# 4) Build Prompts
 # ============================================================
-def build_prompt_summary(doc_text: str) -> str:
-    return f"""
+# 고정 프롬프트 앞부분은 모듈 로드 시 한 번만 조립 (호출 시에는 문서/질문 부분만 결합)
+_PREFIX_SUMMARY: Final[str] = f"""
 {PROMPT_COMMON_RULES}
 {PROMPT_OPTIONS}
 {PROMPT_SECTIONS_SUMMARY}
 
 {TASK_SUMMARY}
-
-[문서 텍스트]
-{doc_text}
 """.strip()
 
-
-def build_prompt_edu_qa(doc_text: str, num_q: int) -> str:
-    spec = PROMPT_EDU_QA_SPEC.format(num_q=num_q)
-    return f"""
+# {num_q} 자리표시자는 유지
+_PREFIX_EDU_QA_TEMPLATE: Final[str] = f"""
 {PROMPT_COMMON_RULES}
 {PROMPT_OPTIONS}
-{spec}
+{PROMPT_EDU_QA_SPEC}
 
 {TASK_EDU_QA}
-
-[문서 텍스트]
-{doc_text}
 """.strip()
 
+_PREFIX_BOTH_TEMPLATE: Final[str] = f"""
+{PROMPT_COMMON_RULES}
+{PROMPT_OPTIONS}
+{PROMPT_SECTIONS_SUMMARY}
+{PROMPT_EDU_QA_SPEC}
 
-def build_prompt_chat(doc_text: str, chat_history: List[Dict[str, str]], user_q: str) -> str:
-    # 히스토리는 길이 제한이 필요 (너무 길면 API 문제)
-    # 최근 N턴만 포함
-    last_turns = chat_history[-6:] if chat_history else []
-    history_txt = "\n".join([f"{m['role']}: {m['content']}" for m in last_turns])
+{TASK_BOTH}
+""".strip()
 
-    return f"""
+_PREFIX_CHAT: Final[str] = f"""
 {PROMPT_COMMON_RULES}
 {PROMPT_OPTIONS}
 {PROMPT_CHAT_SPEC}
 
 {TASK_CHAT}
+""".strip()
 
-[대화 기록(최근)]
-{history_txt}
+_NOTE_FILE_FALLBACK: Final[str] = "※ 문서 텍스트 추출이 부족하여 파일 기반으로 분석합니다."
 
-[사용자 질문]
-{user_q}
+_PROMPT_SUMMARY_FILE: Final[str] = f"{_PREFIX_SUMMARY}\n\n{_NOTE_FILE_FALLBACK}"
+
+
+def build_prompt_summary(doc_text: str) -> str:
+    return f"{_PREFIX_SUMMARY}\n\n[문서 텍스트]\n{doc_text}"
 
-[문서 텍스트]
-{doc_text}
-""".strip()
+
+def _prefix_edu_qa(num_q: int, part: int, parts: int) -> str:
+    prefix = _PREFIX_EDU_QA_TEMPLATE.format(num_q=num_q)
+    if parts > 1:
+        prefix += "\n" + PROMPT_EDU_QA_PART.format(part=part, parts=parts).rstrip()
+    return prefix
+
+
+def build_prompt_edu_qa(doc_text: str, num_q: int, part: int = 1, parts: int = 1) -> str:
+    return f"{_prefix_edu_qa(num_q, part, parts)}\n\n[문서 텍스트]\n{doc_text}"
+
+
+def build_prompt_both(doc_text: str, num_q: int) -> str:
+    return f"{_PREFIX_BOTH_TEMPLATE.format(num_q=num_q)}\n\n[문서 텍스트]\n{doc_text}"
+
+
+def build_prompt_chat(doc_text: str, chat_history: Deque[Dict[str, str]], user_q: str) -> str:
+    # 히스토리는 길이 제한이 필요 (너무 길면 API 문제)
+    # 최근 N턴만 포함
+    last_turns = list(chat_history)[-6:] if chat_history else []
+    history_txt = "\n".join([f"{m['role']}: {m['content']}" for m in last_turns])
+
+    return (
+        f"{_PREFIX_CHAT}\n\n"
+        f"[대화 기록(최근)]\n{history_txt}\n\n"
+        f"[사용자 질문]\n{user_q}\n\n"
+        f"[문서 텍스트]\n{doc_text}"
+    )
+
+
+# 파일 기반(업로드 대체 경로) 프롬프트: 문서 텍스트 대신 업로드된 파일을 함께 전달
+def build_prompt_summary_file() -> str:
+    return _PROMPT_SUMMARY_FILE
+
+
+def build_prompt_edu_qa_file(num_q: int, part: int = 1, parts: int = 1) -> str:
+    return f"{_prefix_edu_qa(num_q, part, parts)}\n\n{_NOTE_FILE_FALLBACK}"
+
+
+def build_prompt_both_file(num_q: int) -> str:
+    return f"{_PREFIX_BOTH_TEMPLATE.format(num_q=num_q)}\n\n{_NOTE_FILE_FALLBACK}"
+
+
+def build_prompt_chat_file(user_q: str) -> str:
+    return f"{_PREFIX_CHAT}\n\n[사용자 질문]\n{user_q}\n\n{_NOTE_FILE_FALLBACK}"
 
 
 # ============================================================
-# 7) Sidebar UI (Korean)
+# 5) Sidebar UI (Korean)
 # ============================================================
 with st.sidebar:
     st.header("설정 및 업로드")
@@ -270,6 +398,11 @@ with st.sidebar:
     st.subheader("처리 모드")
     prefer_local_parse = st.checkbox("로컬 텍스트 파싱 우선(권장)", value=True)
     allow_file_fallback = st.checkbox("텍스트 부족 시 업로드 대체 경로 허용", value=True)
+    fast_summary = st.checkbox(
+        "빠른 요약 모드",
+        value=False,
+        help=f"{FAST_SUMMARY_MIN_PAGES}쪽 이상 문서는 요약 리포트에 목차와 앞/뒤 일부 페이지만 사용합니다. (Q&A·추가 질의는 전체 텍스트 사용)",
+    )
 
     uploaded_file = st.file_uploader("KIHS 보고서 PDF 업로드", type=["pdf"])
 
@@ -285,22 +418,50 @@ with st.sidebar:
 
 
 # ============================================================
-# 8) Session State
+# 6) Session State
 # ============================================================
 if "last_uploaded" not in st.session_state:
     st.session_state.last_uploaded = None
+# 업로드 위젯의 file_id → 내용 해시 (재실행마다 PDF 전체를 다시 해시하지 않도록)
+if "digest_by_file_id" not in st.session_state:
+    st.session_state.digest_by_file_id = {}
 if "parsed_text" not in st.session_state:
     st.session_state.parsed_text = ""
 if "n_pages" not in st.session_state:
     st.session_state.n_pages = 0
-if "file_ref" not in st.session_state:
-    st.session_state.file_ref = None
+# 업로드 대체 경로로 올린 파일은 URI 문자열만 보관 (요청 시 file_part()로 참조 생성)
+if "file_uri" not in st.session_state:
+    st.session_state.file_uri = None
+# 업로드 대체 경로로 올린 파일: 내용 해시 → file_uri (같은 PDF 재업로드 시 업로드 생략)
+# - Gemini 파일은 업로드한 API 키에서만 접근 가능하므로 세션 단위로 보관
+if "file_uris" not in st.session_state:
+    st.session_state.file_uris = {}
+# 진행 중인 업로드 대체 경로: (내용 해시, Future) — 결과는 resolve_file_uri()에서 확정
+if "upload_pending" not in st.session_state:
+    st.session_state.upload_pending = None
+# 제출한 배치 작업: {"name", "model", "requests"} (결과를 응답 캐시에 넣을 때 키로 사용)
+if "batch_job" not in st.session_state:
+    st.session_state.batch_job = None
+# 대화 기록은 최근 CHAT_HISTORY_MAX개 메시지만 보관 (오래된 것부터 O(1) 제거, 세션 상태 크기 상한)
+CHAT_HISTORY_MAX = 20
 if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []  # list of {role, content}
+    st.session_state.chat_history = deque(maxlen=CHAT_HISTORY_MAX)  # deque of {role, content}
+if "doc_text_key" not in st.session_state:
+    st.session_state.doc_text_key = None
+    st.session_state.doc_text = ""
+
+
+# 모델 입력용 문서 텍스트는 (파일, 파싱 결과, 상한)이 같으면 재사용 — 탭/대화 턴마다 다시 자르지 않음
+def get_doc_text(max_chars: int) -> str:
+    key = (st.session_state.last_uploaded, len(st.session_state.parsed_text), max_chars)
+    if st.session_state.doc_text_key != key:
+        st.session_state.doc_text = trim_by_tokens(st.session_state.parsed_text, max_chars=max_chars)
+        st.session_state.doc_text_key = key
+    return st.session_state.doc_text
 
 
 # ============================================================
-# 9) Main Logic
+# 7) Main Logic
 # ============================================================
 if not uploaded_file:
     st.info("좌측 사이드바에서 PDF 파일을 업로드하세요.")
@@ -310,35 +471,212 @@ if not uploaded_file:
     st.markdown("- 2022_KIHS_Water Resources Forum_Final Report.pdf")
     st.stop()
 
-# 새 파일이면 상태 초기화
-if st.session_state.last_uploaded != uploaded_file.name:
-    st.session_state.last_uploaded = uploaded_file.name
+# 파일 내용 해시는 업로드(file_id)당 한 번만 계산 — 이후 재실행은 사전 조회
+file_digest = st.session_state.digest_by_file_id.get(uploaded_file.file_id)
+if file_digest is None:
+    file_digest = content_digest(uploaded_file.getbuffer())
+    st.session_state.digest_by_file_id[uploaded_file.file_id] = file_digest
+
+# 새 파일이면 상태 초기화 (파일 이름이 아닌 내용 해시로 판단)
+if st.session_state.last_uploaded != file_digest:
+    st.session_state.last_uploaded = file_digest
     st.session_state.parsed_text = ""
     st.session_state.n_pages = 0
-    st.session_state.file_ref = None
-    st.session_state.chat_history = []
-
-# 1) 로컬 파싱(우선)
+    st.session_state.file_uri = st.session_state.file_uris.get(file_digest)
+    if st.session_state.upload_pending is not None:
+        discard_pdf_upload(client, st.session_state.upload_pending[1])
+        st.session_state.upload_pending = None
+    st.session_state.batch_job = None
+    st.session_state.chat_history = deque(maxlen=CHAT_HISTORY_MAX)
+    st.session_state.doc_text_key = None
+    st.session_state.doc_text = ""
+
+# 1) 로컬 파싱(우선) — 업로드 대체 경로는 파싱과 동시에 미리 시작
 MIN_TEXT_CHARS = 1200
+
+
+# PDF 바이트(bytes 사본)는 파싱/업로드/발췌 캐시가 미스일 때만 만들고 세션에 보관하지 않음
+# (해시는 getbuffer()로 복사 없이 계산)
+def start_upload_pending(file_bytes: bytes) -> None:
+    fut = start_pdf_upload(client, file_bytes, uploaded_file.name)
+    st.session_state.upload_pending = (file_digest, fut)
+
+
 if prefer_local_parse and not st.session_state.parsed_text:
-    with st.spinner("PDF 텍스트 추출(로컬 파싱) 중..."):
-        try:
-            text, n_pages = extract_text_from_pdf(uploaded_file)
-            text = normalize_text(text)
-            st.session_state.parsed_text = text
-            st.session_state.n_pages = n_pages
-        except Exception as e:
-            st.error("PDF 텍스트 추출 실패")
-            st.exception(e)
+    cached_parse = parsed_pdf_lookup(file_digest)
+    if cached_parse is not None:
+        # 이미 파싱한 문서: 텍스트 충분 여부를 바로 알 수 있으므로 미리 업로드하지 않음
+        st.session_state.parsed_text, st.session_state.n_pages = cached_parse
+    else:
+        file_bytes = uploaded_file.getvalue()
+        if allow_file_fallback and st.session_state.file_uri is None and st.session_state.upload_pending is None:
+            # 스캔 PDF 대비: 파싱 결과를 기다리지 않고 업로드를 시작(불필요하면 아래에서 폐기)
+            start_upload_pending(file_bytes)
+
+        with st.status("PDF 텍스트 추출(로컬 파싱) 중...") as parse_status:
+            def report_progress(done: int, total: int) -> None:
+                parse_status.update(label=f"PDF 텍스트 추출(로컬 파싱) 중... {done}/{total} 페이지")
+
+            try:
+                text, n_pages = parse_pdf_cached(file_digest, file_bytes, progress=report_progress)
+                st.session_state.parsed_text = text
+                st.session_state.n_pages = n_pages
+                parse_status.update(label=f"PDF 텍스트 추출 완료 ({n_pages} 페이지)", state="complete")
+            except Exception as e:
+                parse_status.update(label="PDF 텍스트 추출 실패", state="error", expanded=True)
+                st.exception(e)
 
 st.success(f"문서 로드 완료: {uploaded_file.name}")
 st.caption(f"페이지 수: {st.session_state.n_pages} | 추출 텍스트 길이: {len(st.session_state.parsed_text):,} chars")
 
 # 2) 텍스트 부족하면 업로드 대체 경로(선택)
 text_insufficient = len(st.session_state.parsed_text) < MIN_TEXT_CHARS
-if text_insufficient and allow_file_fallback and st.session_state.file_ref is None:
-    st.warning("텍스트 추출이 부족합니다(스캔 PDF 가능). 업로드 대체 경로를 시도합니다.")
-    st.session_state.file_ref = upload_pdf_to_gemini_file_api(client, uploaded_file)
+# - 업로드는 백그라운드에서 진행하고, 결과는 버튼을 눌렀을 때 확정(화면은 바로 표시)
+if text_insufficient and allow_file_fallback and st.session_state.file_uri is None:
+    if st.session_state.upload_pending is None:
+        start_upload_pending(uploaded_file.getvalue())
+    if st.session_state.upload_pending[1].done():
+        resolve_file_uri()
+    else:
+        st.warning("텍스트 추출이 부족합니다(스캔 PDF 가능). 업로드 대체 경로를 백그라운드에서 준비합니다.")
+elif st.session_state.upload_pending is not None:
+    discard_pdf_upload(client, st.session_state.upload_pending[1])
+    st.session_state.upload_pending = None
+
+# 3) 요약/Q&A 요청 구성 — 텍스트도 업로드 대체 경로도 없으면 None
+text_ready = not text_insufficient
+use_fast_summary = text_ready and fast_summary and st.session_state.n_pages >= FAST_SUMMARY_MIN_PAGES
+NO_SOURCE_ERROR: Final[str] = "텍스트도 부족하고 업로드 대체 경로도 준비되지 않았습니다."
+
+
+def summary_request() -> Optional[GenRequest]:
+    if text_ready:
+        if use_fast_summary:
+            excerpt = pdf_excerpt_lookup(file_digest)
+            if excerpt is None:
+                excerpt = parse_pdf_excerpt_cached(file_digest, uploaded_file.getvalue())
+            doc_text = trim_by_tokens(excerpt, max_chars=max_chars)
+        else:
+            doc_text = get_doc_text(max_chars)
+        return GenRequest(build_prompt_summary(doc_text))
+    file_uri = resolve_file_uri()
+    if file_uri is not None:
+        return GenRequest([file_part(file_uri), build_prompt_summary_file()], file_digest)
+    return None
+
+
+# 교육형 Q&A는 EDU_QA_SPLIT_ABOVE를 넘을 때만 EDU_QA_BATCH_SIZE 이하의 묶음으로 균등 분할 (예: 12문항 → 6 + 6)
+def qa_requests() -> Optional[List[GenRequest]]:
+    parts = 1 if num_q <= EDU_QA_SPLIT_ABOVE else -(-num_q // EDU_QA_BATCH_SIZE)
+    sizes = [num_q // parts + (1 if i < num_q % parts else 0) for i in range(parts)]
+    if text_ready:
+        doc_text = get_doc_text(max_chars)
+        return [
+            GenRequest(build_prompt_edu_qa(doc_text, n, part, parts), config=EDU_QA_CONFIG, validate=is_edu_qa_output)
+            for part, n in enumerate(sizes, 1)
+        ]
+    file_uri = resolve_file_uri()
+    if file_uri is not None:
+        return [
+            GenRequest(
+                [file_part(file_uri), build_prompt_edu_qa_file(n, part, parts)],
+                file_digest,
+                EDU_QA_CONFIG,
+                is_edu_qa_output,
+            )
+            for part, n in enumerate(sizes, 1)
+        ]
+    return None
+
+
+def both_request() -> Optional[GenRequest]:
+    if text_ready:
+        return GenRequest(
+            build_prompt_both(get_doc_text(max_chars), num_q=num_q), config=BOTH_CONFIG, validate=is_both_output
+        )
+    file_uri = resolve_file_uri()
+    if file_uri is not None:
+        return GenRequest(
+            [file_part(file_uri), build_prompt_both_file(num_q=num_q)], file_digest, BOTH_CONFIG, is_both_output
+        )
+    return None
+
+
+# 4) 요약 + Q&A 동시 생성: 한 번의 호출로 두 결과를 받아 각 탭에 표시
+# - 빠른 요약 모드는 요약(발췌)과 Q&A(전체 문서)의 입력이 달라 두 요청을 병렬로 보냄
+btn_both = st.button("요약 리포트 + 교육형 Q&A 동시 생성", key="btn_both")
+both_outputs = None
+if btn_both:
+    with st.spinner("요약 리포트와 교육형 Q&A 동시 생성 중..."):
+        try:
+            if use_fast_summary:
+                summary_req, qa_reqs = summary_request(), qa_requests()
+                has_source = summary_req is not None and qa_reqs is not None
+                if has_source:
+                    outs = generate_many_cached(client, model, [summary_req, *qa_reqs], return_exceptions=True)
+                    if isinstance(outs[0], Exception):
+                        raise outs[0]
+                    both_outputs = [outs[0], merge_edu_qa(outs[1:])]
+            else:
+                req = both_request()
+                has_source = req is not None
+                if has_source:
+                    parsed = split_both_output(generate_cached(client, model, req))
+                    if parsed is not None:
+                        summary, edu_qa = parsed
+                        # 탭별 버튼에서도 바로 쓰도록 각 요청의 캐시에도 저장 (Q&A는 분할되지 않은 경우만)
+                        both_outputs = [store_generated(model, summary_request(), summary), edu_qa]
+                        qa_reqs = qa_requests()
+                        if len(qa_reqs) == 1:
+                            store_generated(model, qa_reqs[0], edu_qa)
+            if not has_source:
+                st.error(NO_SOURCE_ERROR)
+        except Exception as e:
+            st.error("동시 생성 중 오류가 발생했습니다.")
+            st.exception(e)
+
+# 5) 배치 작업(Batch API): 같은 요청을 저비용 비동기 작업으로 제출하고 나중에 결과 확인
+with st.expander("🗂️ 배치 작업으로 제출 (저비용 · 완료까지 수 분 이상 소요)"):
+    col_submit, col_check = st.columns(2)
+    btn_batch_submit = col_submit.button("요약 + Q&A 배치 제출", key="btn_batch_submit")
+    if btn_batch_submit:
+        batch_requests = [summary_request(), *(qa_requests() or [None])]
+        if None in batch_requests:
+            st.error(NO_SOURCE_ERROR)
+        else:
+            try:
+                name = submit_batch(client, model, batch_requests, display_name=f"kihs-{uploaded_file.name}")
+                st.session_state.batch_job = {"name": name, "model": model, "requests": batch_requests}
+            except Exception as e:
+                st.error("배치 작업 제출 중 오류가 발생했습니다.")
+                st.exception(e)
+
+    # 제출 처리 뒤에 그려야 같은 실행에서 바로 활성화됨
+    btn_batch_check = col_check.button(
+        "배치 상태 확인", key="btn_batch_check", disabled=st.session_state.batch_job is None
+    )
+    if btn_batch_check and st.session_state.batch_job is not None:
+        job = st.session_state.batch_job
+        try:
+            state, outs = fetch_batch(client, job["name"])
+            if outs is not None:
+                # 요청별 검사(validate)를 통과한 결과만 응답 캐시에 저장
+                for req, out in zip(job["requests"], outs):
+                    store_generated(job["model"], req, out)
+                st.session_state.batch_job = None
+                both_outputs = [outs[0] if outs else "", merge_edu_qa(outs[1:])]
+                st.success("배치 작업 완료: 결과를 각 탭에 표시합니다.")
+            elif state in BATCH_FAILED_STATES:
+                st.session_state.batch_job = None
+                st.error(f"배치 작업 종료: {state}")
+            else:
+                st.info(f"배치 작업 진행 중: {state} — 잠시 후 다시 확인하세요.")
+        except Exception as e:
+            st.error("배치 상태 확인 중 오류가 발생했습니다.")
+            st.exception(e)
+
+    if st.session_state.batch_job is not None:
+        st.caption(f"제출된 작업: {st.session_state.batch_job['name']}")
 
 # Tabs
 tab1, tab2, tab3, tab4 = st.tabs(["📄 요약 리포트", "🎓 교육형 Q&A", "💬 추가 질의", "🧾 파싱 확인"])
@@ -359,24 +697,22 @@ with tab1:
     if btn_summary:
         with st.spinner("리포트 생성 중..."):
             try:
-                if st.session_state.parsed_text and len(st.session_state.parsed_text) >= MIN_TEXT_CHARS:
-                    doc_text = trim_text(st.session_state.parsed_text, max_chars=max_chars)
-                    prompt = build_prompt_summary(doc_text)
-                    out = generate_with_retry(model=model, contents=prompt, retries=1)
-                    st.markdown(out)
-                elif st.session_state.file_ref is not None:
-                    prompt = (
-                        f"{PROMPT_COMMON_RULES}\n{PROMPT_OPTIONS}\n{PROMPT_SECTIONS_SUMMARY}\n\n"
-                        f"{TASK_SUMMARY}\n\n"
-                        "※ 문서 텍스트 추출이 부족하여 파일 기반으로 분석합니다."
-                    )
-                    out = generate_with_retry(model=model, contents=[st.session_state.file_ref, prompt], retries=1)
-                    st.markdown(out)
+                req = summary_request()
+                if req is None:
+                    st.error(NO_SOURCE_ERROR)
                 else:
-                    st.error("텍스트도 부족하고 업로드 대체 경로도 준비되지 않았습니다.")
+                    if use_fast_summary:
+                        st.caption("빠른 요약 모드: 목차와 앞/뒤 일부 페이지만 사용했습니다.")
+                    out = generate_stream_cached(
+                        client, model=model, contents=req.contents, placeholder=st.empty(), doc_key=req.doc_key
+                    )
             except Exception as e:
                 st.error("요약 리포트 생성 중 오류가 발생했습니다.")
                 st.exception(e)
+    elif both_outputs is not None:
+        if use_fast_summary:
+            st.caption("빠른 요약 모드: 목차와 앞/뒤 일부 페이지만 사용했습니다.")
+        st.markdown(both_outputs[0])
 
 # ------------------------------------------------------------
 # Tab2: Educational Q&A
@@ -389,25 +725,16 @@ with tab2:
     if btn_qa:
         with st.spinner("교육형 Q&A 생성 중..."):
             try:
-                if st.session_state.parsed_text and len(st.session_state.parsed_text) >= MIN_TEXT_CHARS:
-                    doc_text = trim_text(st.session_state.parsed_text, max_chars=max_chars)
-                    prompt = build_prompt_edu_qa(doc_text, num_q=num_q)
-                    out = generate_with_retry(model=model, contents=prompt, retries=1)
-                    st.markdown(out)
-                elif st.session_state.file_ref is not None:
-                    prompt = (
-                        f"{PROMPT_COMMON_RULES}\n{PROMPT_OPTIONS}\n"
-                        f"{PROMPT_EDU_QA_SPEC.format(num_q=num_q)}\n\n"
-                        f"{TASK_EDU_QA}\n\n"
-                        "※ 문서 텍스트 추출이 부족하여 파일 기반으로 분석합니다."
-                    )
-                    out = generate_with_retry(model=model, contents=[st.session_state.file_ref, prompt], retries=1)
-                    st.markdown(out)
+                reqs = qa_requests()
+                if reqs is None:
+                    st.error(NO_SOURCE_ERROR)
                 else:
-                    st.error("텍스트도 부족하고 업로드 대체 경로도 준비되지 않았습니다.")
+                    render_edu_qa(merge_edu_qa(generate_many_cached(client, model, reqs, return_exceptions=True)))
             except Exception as e:
                 st.error("교육형 Q&A 생성 중 오류가 발생했습니다.")
                 st.exception(e)
+    elif both_outputs is not None:
+        render_edu_qa(both_outputs[1])
 
 # ------------------------------------------------------------
 # Tab3: Chat / Follow-up queries
@@ -416,49 +743,56 @@ with tab3:
     st.markdown("### 💬 추가 질의 (문서 기반 Q&A)")
     st.caption("보고서 내용에 대해 추가 질문을 입력하면, 문서 근거 중심으로 답합니다.")
 
-    # 대화 표시
-    if st.session_state.chat_history:
+    # 대화 표시: 기록과 새 턴을 하나의 컨테이너에 순서대로 배치
+    # (매 재실행마다 요소 위치가 고정되어 프런트엔드가 바뀌지 않은 메시지를 그대로 재사용)
+    chat_container = st.container()
+    with chat_container:
         for m in st.session_state.chat_history:
             with st.chat_message("user" if m["role"] == "user" else "assistant"):
                 st.markdown(m["content"])
-    else:
-        st.info("아직 대화가 없습니다. 아래 입력창에 질문을 입력해 보세요.")
+        empty_notice = st.empty()
+        if not st.session_state.chat_history:
+            empty_notice.info("아직 대화가 없습니다. 아래 입력창에 질문을 입력해 보세요.")
 
     user_q = st.chat_input("추가 질문을 입력하세요 (예: 이 보고서의 핵심 데이터는 무엇인가요?)")
 
     if user_q:
+        empty_notice.empty()
+
         # store user msg
         st.session_state.chat_history.append({"role": "user", "content": user_q})
 
-        with st.chat_message("user"):
-            st.markdown(user_q)
-
-        with st.spinner("답변 생성 중..."):
-            try:
-                # 텍스트 기반 우선
-                if st.session_state.parsed_text and len(st.session_state.parsed_text) >= MIN_TEXT_CHARS:
-                    doc_text = trim_text(st.session_state.parsed_text, max_chars=max_chars)
-                    prompt = build_prompt_chat(doc_text, st.session_state.chat_history, user_q)
-                    out = generate_with_retry(model=model, contents=prompt, retries=1)
-
-                # 업로드 대체 경로
-                elif st.session_state.file_ref is not None:
-                    prompt = (
-                        f"{PROMPT_COMMON_RULES}\n{PROMPT_OPTIONS}\n{PROMPT_CHAT_SPEC}\n\n"
-                        f"{TASK_CHAT}\n\n"
-                        f"[사용자 질문]\n{user_q}\n\n"
-                        "※ 문서 텍스트 추출이 부족하여 파일 기반으로 분석합니다."
-                    )
-                    out = generate_with_retry(model=model, contents=[st.session_state.file_ref, prompt], retries=1)
-                else:
-                    out = "텍스트도 부족하고 업로드 대체 경로도 준비되지 않았습니다. (옵션/네트워크 확인)"
-
-                # store assistant msg
-                st.session_state.chat_history.append({"role": "assistant", "content": out})
-
-                with st.chat_message("assistant"):
-                    st.markdown(out)
-
-            except Exception as e:
-                st.error("추가 질의 처리 중 오류가 발생했습니다.")
-                st.exception(e)
+        with chat_container:
+            with st.chat_message("user"):
+                st.markdown(user_q)
+
+            with st.spinner("답변 생성 중..."):
+                try:
+                    with st.chat_message("assistant"):
+                        placeholder = st.empty()
+
+                        # 텍스트 기반 우선
+                        if text_ready:
+                            doc_text = get_doc_text(max_chars)
+                            prompt = build_prompt_chat(doc_text, st.session_state.chat_history, user_q)
+                            out = generate_stream(client, model=model, contents=prompt, placeholder=placeholder)
+
+                        # 업로드 대체 경로
+                        elif resolve_file_uri() is not None:
+                            prompt = build_prompt_chat_file(user_q)
+                            out = generate_stream(
+                                client,
+                                model=model,
+                                contents=[file_part(st.session_state.file_uri), prompt],
+                                placeholder=placeholder,
+                            )
+                        else:
+                            out = "텍스트도 부족하고 업로드 대체 경로도 준비되지 않았습니다. (옵션/네트워크 확인)"
+                            placeholder.markdown(out)
+
+                    # store assistant msg
+                    st.session_state.chat_history.append({"role": "assistant", "content": out})
+
+                except Exception as e:
+                    st.error("추가 질의 처리 중 오류가 발생했습니다.")
+                    st.exception(e)
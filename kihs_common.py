@@ -0,0 +1,652 @@
+# ============================================================
+# KIHS 보고서 분석기 공통 모듈
+# - PDF 파싱, 업로드 대체 경로, Gemini 호출(재시도), 클라이언트, 공통 프롬프트
+# - Streamlit UI 코드(app.py)와 분리
+# ============================================================
+import io
+import hashlib
+import os
+import re
+import time
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Callable, Dict, Final, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import streamlit as st
+from pypdf import PdfReader
+
+# google-genai(수백 ms 규모)는 실제 API 호출 경로에서만 import: 서버 기동 직후 첫 화면 표시가 빨라짐
+if TYPE_CHECKING:
+    from google import genai
+    from google.genai import types as genai_types
+
+try:
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+except ImportError:  # 네이티브 휠이 없는 환경에서는 pypdf 경로로 동작
+    pdfium = None
+
+try:
+    import xxhash
+except ImportError:  # 없으면 hashlib.blake2b로 동작
+    xxhash = None
+
+
+# ============================================================
+# 1) Common Prompt Rules
+# ============================================================
+PROMPT_COMMON_RULES: Final[str] = """
+[공통 규칙]
+- 반드시 한국어로 답변하세요.
+- 당신은 'KIHS(한국수자원조사기술원) 보고서 기반 교육/분석 튜터'입니다.
+- 문서에 없는 내용은 만들지 말고, 불확실하면 '문서에서 확인 불가'라고 명시하세요.
+- 가능한 경우, 근거가 되는 문서 표현을 1~2문장으로 요약해 함께 제시하세요(직접 인용은 1문장 이내).
+- 과장 없이 간결하고 단정한 문장으로 작성하세요.
+"""
+
+PROMPT_OPTIONS: Final[str] = """
+[옵션]
+- 톤: 공공기관 보고서 스타일(차분, 단정, 과장 없음) + 학습자 친화(핵심→설명→정리)
+- 독자: 수자원/물관리 분야 실무자 및 연구자(초중급 포함)
+- 금지: 홍보성 표현, 감정적 표현, 근거 없는 단정, 과도한 상상
+- 용어: 한국어 용어 우선(예: water treatment plant=정수장)
+"""
+
+
+# ============================================================
+# 2) Gemini Client
+# ============================================================
+# 재실행(위젯 조작)마다 클라이언트를 새로 만들지 않도록 API Key별로 1개를 유지
+@st.cache_resource(show_spinner=False)
+def get_client(api_key: str) -> "genai.Client":
+    from google import genai
+
+    return genai.Client(api_key=api_key)
+
+
+# ============================================================
+# 3) PDF Parsing (Primary path for stability)
+# ============================================================
+# PDFium은 스레드 안전하지 않으므로 모든 PDFium 호출(세션별 스크립트 스레드)은 _PDFIUM_LOCK으로 직렬화
+# - 순차 추출만으로도 충분히 빠르고(수백 페이지 < 1초), 같은 문서는 파싱 캐시가 재사용하므로 프로세스 풀은 두지 않음
+_PDFIUM_LOCK = threading.Lock()
+
+
+# 빈 페이지(간지/표지 뒷면 등)는 가장 비싼 텍스트 추출 단계를 건너뜀
+def _pdfium_page_text(doc, i: int) -> str:
+    try:
+        page = doc[i]
+        try:
+            if pdfium_c.FPDFPage_CountObjects(page.raw) == 0:
+                return ""
+            textpage = page.get_textpage()
+            t = textpage.get_text_range() or ""
+            textpage.close()
+        finally:
+            page.close()
+    except Exception:
+        return ""
+    return t.replace("\r\n", "\n").strip()
+
+
+def _pypdf_page_text(page) -> str:
+    try:
+        # 본문 스트림에 텍스트 객체(BT)도 폼 XObject 호출(Do)도 없으면 빈 페이지
+        contents = page.get_contents()
+        if contents is None:
+            return ""
+        data = contents.get_data()
+        if b"BT" not in data and b"Do" not in data:
+            return ""
+        return (page.extract_text() or "").strip()
+    except Exception:
+        return ""
+
+
+def _write_page(buf: io.StringIO, i: int, t: str) -> None:
+    # 페이지별 f-string/리스트 없이 버퍼에 바로 기록: "[PAGE n]\n본문\n\n"
+    buf.write("[PAGE ")
+    buf.write(str(i + 1))
+    buf.write("]\n")
+    buf.write(t)
+    buf.write("\n\n")
+
+
+# 페이지 텍스트 목록(0-based 순서) → "[PAGE n]" 표기 문서 텍스트 (빈 페이지는 제외)
+def _assemble_pages(texts: List[str]) -> str:
+    buf = io.StringIO()
+    for i, t in enumerate(texts):
+        if t:
+            _write_page(buf, i, t)
+    return buf.getvalue().strip()
+
+
+# 진행률 콜백: progress(처리한 페이지 수, 전체 페이지 수) — 스크립트 스레드에서 호출됨
+ProgressFn = Callable[[int, int], None]
+PROGRESS_STEP = 16
+
+
+def _extract_text_pypdf(data: bytes, progress: Optional[ProgressFn] = None) -> Tuple[str, int]:
+    reader = PdfReader(io.BytesIO(data))
+    pages = reader.pages
+    n_pages = len(pages)
+    texts: List[str] = []
+    for start in range(0, n_pages, PROGRESS_STEP):
+        stop = min(start + PROGRESS_STEP, n_pages)
+        texts.extend(_pypdf_page_text(pages[i]) for i in range(start, stop))
+        if progress is not None:
+            progress(stop, n_pages)
+    return _assemble_pages(texts), n_pages
+
+
+def extract_text_from_pdf(data: bytes, progress: Optional[ProgressFn] = None) -> Tuple[str, int]:
+    if pdfium is None:
+        return _extract_text_pypdf(data, progress)
+
+    # pdfium(C++) 엔진: 파일 바이트로 문서를 연다
+    with _PDFIUM_LOCK:
+        doc = pdfium.PdfDocument(data)
+        n_pages = len(doc)
+
+    texts: List[str] = []
+    try:
+        for start in range(0, n_pages, PROGRESS_STEP):
+            stop = min(start + PROGRESS_STEP, n_pages)
+            # 진행률 UI 갱신 중에는 다른 세션이 PDFium을 쓸 수 있도록 구간 단위로 잠금
+            with _PDFIUM_LOCK:
+                texts.extend(_pdfium_page_text(doc, i) for i in range(start, stop))
+            if progress is not None:
+                progress(stop, n_pages)
+    finally:
+        with _PDFIUM_LOCK:
+            doc.close()
+
+    return _assemble_pages(texts), n_pages
+
+
+# 파일 내용 기준 식별자: 이름이 달라도 같은 PDF면 같은 값
+# - 보안용이 아닌 캐시 키이므로 가장 빠른 해시 사용 (xxh3_128 ≫ blake2b, 둘 다 memoryview를 복사 없이 처리)
+def content_digest(data) -> str:
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+_MULTI_NL = re.compile(r"\n{3,}")
+
+
+def normalize_text(text: str) -> str:
+    t = (text or "").replace("\r", "\n")
+    return _MULTI_NL.sub("\n\n", t).strip()
+
+
+# 파일 내용 해시(content_digest) 기준 캐시 항목: _parsed 없이 호출하면 조회만(미스는 KeyError, 예외는 캐시되지 않음)
+# - 파일 바이트 대신 해시를 키로 써서 호출마다 Streamlit이 PDF 전체를 다시 해시하지 않도록 함
+@st.cache_data(show_spinner=False, max_entries=32)
+def _parsed_pdf_entry(digest: str, _parsed: Optional[Tuple[str, int]] = None) -> Tuple[str, int]:
+    if _parsed is None:
+        raise KeyError("parsed pdf not cached")
+    return _parsed
+
+
+# 파싱 결과 조회만 (미스면 None)
+def parsed_pdf_lookup(digest: str) -> Optional[Tuple[str, int]]:
+    try:
+        return _parsed_pdf_entry(digest)
+    except KeyError:
+        return None
+
+
+# 재실행/재업로드/다른 사용자의 동일 파일은 파싱 생략
+# - 추출은 캐시 함수 밖에서 실행: 진행률 UI 갱신이 캐시 재생(replay) 대상으로 기록되지 않도록
+def parse_pdf_cached(
+    digest: str, file_bytes: bytes, progress: Optional[ProgressFn] = None
+) -> Tuple[str, int]:
+    cached = parsed_pdf_lookup(digest)
+    if cached is not None:
+        return cached
+    text, n_pages = extract_text_from_pdf(file_bytes, progress)
+    return _parsed_pdf_entry(digest, (normalize_text(text), n_pages))
+
+
+# 빠른 요약 모드: 긴 문서는 목차(북마크) + 앞/뒤 일부 페이지만 모델에 전달
+FAST_SUMMARY_MIN_PAGES = 20
+FAST_SUMMARY_HEAD_PAGES = 3
+FAST_SUMMARY_TAIL_PAGES = 2
+
+
+def _toc_pypdf(reader: PdfReader) -> List[Tuple[int, str, Optional[int]]]:
+    toc = []
+
+    def walk(items, level: int) -> None:
+        for it in items:
+            if isinstance(it, list):
+                walk(it, level + 1)
+                continue
+            try:
+                page = reader.get_destination_page_number(it)
+            except Exception:
+                page = None
+            toc.append((level, it.title or "", page))
+
+    walk(reader.outline, 0)
+    return toc
+
+
+def extract_summary_excerpt(data: bytes) -> str:
+    head, tail = FAST_SUMMARY_HEAD_PAGES, FAST_SUMMARY_TAIL_PAGES
+    if pdfium is None:
+        reader = PdfReader(io.BytesIO(data))
+        n_pages = len(reader.pages)
+        toc = _toc_pypdf(reader)
+        pages = sorted(set(range(min(head, n_pages))) | set(range(max(0, n_pages - tail), n_pages)))
+        texts = {i: _pypdf_page_text(reader.pages[i]) for i in pages}
+    else:
+        with _PDFIUM_LOCK:
+            doc = pdfium.PdfDocument(data)
+            try:
+                n_pages = len(doc)
+                toc = []
+                for b in doc.get_toc():
+                    dest = b.get_dest()
+                    toc.append((b.level, b.get_title(), dest.get_index() if dest else None))
+                h = min(head, n_pages)
+                t0 = max(h, n_pages - tail)
+                texts = {i: _pdfium_page_text(doc, i) for i in (*range(h), *range(t0, n_pages))}
+            finally:
+                doc.close()
+
+    buf = io.StringIO()
+    if toc:
+        buf.write("[목차]\n")
+        for level, title, page in toc:
+            buf.write("  " * level)
+            buf.write(f"- {title.strip()}")
+            if page is not None:
+                buf.write(f" (p.{page + 1})")
+            buf.write("\n")
+        buf.write("\n")
+    for i in sorted(texts):
+        if texts[i]:
+            _write_page(buf, i, texts[i])
+
+    return normalize_text(buf.getvalue())
+
+
+# 빠른 요약 발췌 캐시 항목: 파싱 결과와 같은 조회/저장 방식 (조회만 하면 PDF 바이트가 필요 없음)
+@st.cache_data(show_spinner=False, max_entries=32)
+def _excerpt_entry(digest: str, _excerpt: Optional[str] = None) -> str:
+    if _excerpt is None:
+        raise KeyError("excerpt not cached")
+    return _excerpt
+
+
+# 발췌 조회만 (미스면 None)
+def pdf_excerpt_lookup(digest: str) -> Optional[str]:
+    try:
+        return _excerpt_entry(digest)
+    except KeyError:
+        return None
+
+
+def parse_pdf_excerpt_cached(digest: str, file_bytes: bytes) -> str:
+    cached = pdf_excerpt_lookup(digest)
+    if cached is not None:
+        return cached
+    return _excerpt_entry(digest, extract_summary_excerpt(file_bytes))
+
+
+def trim_text(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + "\n\n[...입력 길이 제한으로 일부 생략됨...]"
+
+
+# 모델 입력용: 문자 수 상한(max_chars) 안에서 UTF-8 바이트 상한(max_chars*3 ≈ 한글 max_chars자)까지만 전달
+# - 바이트 상한만 쓰면 영문 위주 문서가 문자 수로 3배까지 들어가므로 문자 수로도 제한
+# - 문서 전체가 아닌 잘라낸 앞부분만 인코딩
+def trim_by_tokens(text: str, max_chars: int) -> str:
+    head = text[:max_chars]
+    limit = max_chars * 3
+    b = head.encode("utf-8")
+    if len(b) > limit:
+        head = b[:limit].decode("utf-8", errors="ignore")
+    if len(head) == len(text):
+        return text
+    return head + "\n\n[...입력 길이 제한으로 일부 생략됨...]"
+
+
+# ============================================================
+# 4) Gemini File Upload Fallback (optional)
+# ============================================================
+def _upload_pdf_bytes(client, data: bytes, display_name: Optional[str] = None) -> object:
+    # 작업 스레드에서 실행되므로 st.* 호출 없이 예외만 전달
+    # 임시 파일 없이 메모리 버퍼에서 바로 업로드 (파일 핸들 업로드는 mime_type 필수)
+    from google.genai import types as genai_types
+
+    return client.files.upload(
+        file=io.BytesIO(data),
+        config=genai_types.UploadFileConfig(mime_type="application/pdf", display_name=display_name),
+    )
+
+
+# 업로드된 파일 참조: File 객체 대신 URI만 보관하고 요청 시 Part로 만듦
+def file_part(file_uri: str) -> "genai_types.Part":
+    from google.genai import types as genai_types
+
+    return genai_types.Part.from_uri(file_uri=file_uri, mime_type="application/pdf")
+
+
+# 업로드 전용 스레드 풀: 결과(Future)가 스크립트 실행보다 오래 살아야 하므로 서버 프로세스당 하나를 공유
+# - 생성 요청은 이 풀을 쓰지 않음 (다른 사용자의 대용량 업로드 뒤에서 생성이 대기하지 않도록)
+UPLOAD_MAX_WORKERS = 8
+
+
+@st.cache_resource(show_spinner=False)
+def _get_upload_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS, thread_name_prefix="kihs-upload")
+
+
+def start_pdf_upload(client, data: bytes, display_name: Optional[str] = None) -> Future:
+    return _get_upload_pool().submit(_upload_pdf_bytes, client, data, display_name)
+
+
+def discard_pdf_upload(client, fut: Future) -> None:
+    # 아직 시작 전이면 취소, 이미 진행 중이면 완료 후 서버 측 파일 삭제
+    if fut.cancel():
+        return
+
+    def _cleanup(f: Future) -> None:
+        try:
+            client.files.delete(name=f.result().name)
+        except Exception:
+            pass
+
+    fut.add_done_callback(_cleanup)
+
+
+# ============================================================
+# 5) Gemini Call Wrapper (retry: 429/5xx/network only, exponential backoff)
+# ============================================================
+# 재시도 대상: 429(레이트리밋/쿼터), 5xx(서버 과부하·일시 장애), 타임아웃·연결 끊김(httpx 전송 오류)
+# 그 외 4xx(잘못된 API Key, 요청 형식 오류 등)는 재시도해도 같으므로 즉시 실패
+def _is_transient(e: Exception) -> bool:
+    import httpx
+    from google.genai import errors as genai_errors
+
+    if isinstance(e, genai_errors.APIError):
+        return e.code == 429 or (e.code or 0) >= 500
+    return isinstance(e, (httpx.TimeoutException, httpx.TransportError))
+
+
+# 지수 백오프 + 지터(동시 사용자 재시도가 한 시점에 몰리지 않도록)
+def _backoff_delay(attempt: int) -> float:
+    return min(8.0, 0.5 * 2**attempt + random.random() * 0.25)
+
+
+# 서버가 알려준 대기 시간(초): 429 응답의 RetryInfo.retryDelay("47s") 또는 Retry-After 헤더
+RETRY_DELAY_MAX = 60.0
+
+
+def _server_retry_delay(e: Exception) -> Optional[float]:
+    from google.genai import errors as genai_errors
+
+    if not isinstance(e, genai_errors.APIError):
+        return None
+    details = e.details if isinstance(e.details, dict) else {}
+    err = details.get("error", details)
+    for d in err.get("details") or []:
+        if isinstance(d, dict) and str(d.get("@type", "")).endswith("RetryInfo"):
+            try:
+                return float(str(d.get("retryDelay", "")).rstrip("s"))
+            except ValueError:
+                pass
+    headers = getattr(e.response, "headers", None)
+    if headers is not None:
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def _retry_delay(e: Exception, attempt: int) -> float:
+    delay = _server_retry_delay(e)
+    if delay is None:
+        return _backoff_delay(attempt)
+    return min(RETRY_DELAY_MAX, delay + random.random() * 0.25)
+
+
+def generate_with_retry(client, model: str, contents, config: Optional[dict] = None, retries: int = 3) -> str:
+    for attempt in range(retries + 1):
+        try:
+            resp = client.models.generate_content(model=model, contents=contents, config=config)
+            return resp.text or ""
+        except Exception as e:
+            if attempt >= retries or not _is_transient(e):
+                raise
+            time.sleep(_retry_delay(e, attempt))
+
+
+def _stream_chunks(client, model: str, contents, retries: int) -> Iterator[str]:
+    for attempt in range(retries + 1):
+        started = False
+        try:
+            for chunk in client.models.generate_content_stream(model=model, contents=contents):
+                if chunk.text:
+                    started = True
+                    yield chunk.text
+            return
+        except Exception as e:
+            # 이미 일부가 표시된 뒤의 오류는 재시도하지 않음 (중복/뒤섞인 출력 방지)
+            if started or attempt >= retries or not _is_transient(e):
+                raise
+            time.sleep(_retry_delay(e, attempt))
+
+
+# 응답을 청크 단위로 placeholder에 점진 표시 (첫 토큰까지의 대기 시간 단축)
+def generate_stream(client, model: str, contents, placeholder, retries: int = 3) -> str:
+    out = placeholder.write_stream(_stream_chunks(client, model, contents, retries))
+    # 문자열 청크만 받으므로 보통 str, 청크가 하나도 없으면 빈 결과
+    return out if isinstance(out, str) else ""
+
+
+# ============================================================
+# 6) Response Cache
+# ============================================================
+# 생성 요청 단위: 모델 입력 + 문서 키(파일 경로의 캐시 구분용) + 생성 설정(JSON 출력 등)
+# + 응답 검사(validate): 지정하면 통과한 응답만 캐시 (형식이 깨진 응답이 재생성 없이 계속 재사용되지 않도록)
+class GenRequest(NamedTuple):
+    contents: object
+    doc_key: str = ""
+    config: Optional[dict] = None
+    validate: Optional[Callable[[str], bool]] = None
+
+
+# 생성 결과 디스크 보존 위치: 이 앱 전용 디렉터리 (서버 재시작/재배포 후에도 재생성 없이 표시)
+# - Streamlit의 persist="disk"는 모든 앱이 공유하는 ~/.streamlit/cache에 쓰므로 사용하지 않음
+RESPONSE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "kihs-summarizer", "responses")
+
+
+def _response_path(model: str, prompt: str, doc_key: str) -> str:
+    key = "\0".join((model, doc_key, prompt)).encode("utf-8")
+    return os.path.join(RESPONSE_CACHE_DIR, hashlib.blake2b(key, digest_size=16).hexdigest() + ".txt")
+
+
+def _read_response(path: str) -> Optional[str]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_response(path: str, text: str) -> None:
+    # 임시 파일에 쓴 뒤 교체: 동시에 읽는 쪽이 쓰다 만 파일을 보지 않도록
+    tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except OSError:  # 디스크 보존에 실패해도 메모리 캐시로 동작
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+# 생성 결과 캐시 항목: (모델, 프롬프트, 문서 키) 기준, _text 없이 호출하면 조회만(미스는 KeyError)
+# - 텍스트 경로는 프롬프트에 문서가 포함되므로 문서 키가 비어 있어도 됨
+# - 메모리(max_entries) → 디스크(RESPONSE_CACHE_DIR) 순으로 조회, 저장은 둘 다
+@st.cache_data(show_spinner=False, max_entries=1024)
+def _generated_entry(model: str, prompt: str, doc_key: str, _text: Optional[str] = None) -> str:
+    path = _response_path(model, prompt, doc_key)
+    if _text is None:
+        text = _read_response(path)
+        if text is None:
+            raise KeyError("response not cached")
+        return text
+    _write_response(path, _text)
+    return _text
+
+
+def _prompt_of(contents) -> str:
+    return contents if isinstance(contents, str) else contents[-1]
+
+
+# 같은 문서·같은 설정의 반복 요청은 Gemini 호출 없이 즉시 표시
+def generate_stream_cached(client, model: str, contents, placeholder, doc_key: str = "", retries: int = 3) -> str:
+    prompt = _prompt_of(contents)
+    try:
+        out = _generated_entry(model, prompt, doc_key)
+        placeholder.markdown(out)
+        return out
+    except KeyError:
+        pass
+    out = generate_stream(client, model, contents, placeholder, retries=retries)
+    return store_generated(model, GenRequest(contents, doc_key), out)
+
+
+# 디스크 캐시 정리 (저장 시 최대 RESPONSE_CACHE_PRUNE_INTERVAL마다 한 번, RESPONSE_CACHE_DIR의 응답 파일만)
+# - RESPONSE_CACHE_MAX_AGE보다 오래된 파일과, 최신 RESPONSE_CACHE_MAX_FILES개를 넘는 파일 삭제
+# - 다른 복제본/프로세스가 동시에 지운 파일은 건너뜀 (정리 실패가 생성 결과 표시를 막지 않도록)
+RESPONSE_CACHE_MAX_FILES = 1024
+RESPONSE_CACHE_MAX_AGE = 30 * 24 * 3600.0
+RESPONSE_CACHE_PRUNE_INTERVAL = 3600.0
+_PRUNE_LOCK = threading.Lock()
+_last_prune = 0.0
+
+
+def _prune_response_cache() -> None:
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < RESPONSE_CACHE_PRUNE_INTERVAL or not _PRUNE_LOCK.acquire(blocking=False):
+        return
+    try:
+        _last_prune = now
+        files: List[Tuple[float, str]] = []
+        try:
+            with os.scandir(RESPONSE_CACHE_DIR) as it:
+                for e in it:
+                    if e.name.endswith(".txt"):
+                        try:
+                            files.append((e.stat().st_mtime, e.path))
+                        except OSError:
+                            pass
+        except OSError:
+            return
+        files.sort(reverse=True)
+        for i, (mtime, path) in enumerate(files):
+            if i >= RESPONSE_CACHE_MAX_FILES or now - mtime > RESPONSE_CACHE_MAX_AGE:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    finally:
+        _PRUNE_LOCK.release()
+
+
+def store_generated(model: str, req: GenRequest, text: str) -> str:
+    # 빈 응답(차단 등)과 검사를 통과하지 못한 응답은 캐시하지 않음
+    if not text or (req.validate is not None and not req.validate(text)):
+        return text
+    out = _generated_entry(model, _prompt_of(req.contents), req.doc_key, text)
+    _prune_response_cache()
+    return out
+
+
+# 구조화(JSON) 응답처럼 점진 표시가 의미 없는 요청: 완성된 응답을 한 번에 받아 캐시
+def generate_cached(client, model: str, req: GenRequest, retries: int = 3) -> str:
+    try:
+        return _generated_entry(model, _prompt_of(req.contents), req.doc_key)
+    except KeyError:
+        pass
+    return store_generated(model, req, generate_with_retry(client, model, req.contents, req.config, retries))
+
+
+# 여러 요청을 스레드로 동시에 생성 (서버 대기 시간이 겹치므로 총 소요 ≈ 가장 느린 요청)
+# - 호출마다 캐시 미스 수만큼의 스레드 풀을 따로 만듦: 다른 세션의 업로드/재시도 대기 뒤에 줄 서지 않음
+# - 결과는 요청과 같은 순서, 캐시 적중분은 호출 생략
+# - 작업 스레드에서는 st.* 호출이 불가하므로 스트리밍 대신 완성된 응답을 받음
+# - 완료되는 대로 캐시에 저장하고, 실패한 요청이 있으면 모두 끝난 뒤 첫 예외를 다시 발생
+#   (일부가 실패해도 성공한 응답은 다음 요청에서 재사용)
+# - return_exceptions=True면 예외를 발생시키지 않고 실패한 요청 자리에 예외 객체를 담아 반환
+def generate_many_cached(
+    client, model: str, requests: List[GenRequest], retries: int = 3, return_exceptions: bool = False
+) -> List[Union[str, Exception]]:
+    outs: List[Union[str, Exception]] = []
+    misses: List[int] = []
+    for i, req in enumerate(requests):
+        try:
+            outs.append(_generated_entry(model, _prompt_of(req.contents), req.doc_key))
+        except KeyError:
+            outs.append("")
+            misses.append(i)
+    if not misses:
+        return outs
+
+    errors: List[Exception] = []
+    with ThreadPoolExecutor(max_workers=len(misses), thread_name_prefix="kihs-gen") as ex:
+        futs: Dict[Future, int] = {
+            ex.submit(generate_with_retry, client, model, requests[i].contents, requests[i].config, retries): i
+            for i in misses
+        }
+        for fut in as_completed(futs):
+            i = futs[fut]
+            try:
+                outs[i] = store_generated(model, requests[i], fut.result())
+            except Exception as e:
+                outs[i] = e
+                errors.append(e)
+    if errors and not return_exceptions:
+        raise errors[0]
+    return outs
+
+
+# ============================================================
+# 7) Batch API
+# ============================================================
+# 배치 작업: 비용이 낮은 대신 완료까지 수 분~수 시간 → 제출 후 상태 확인으로 결과 수신
+BATCH_DONE_STATES: Final = ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED")
+BATCH_FAILED_STATES: Final = ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED")
+
+
+def submit_batch(client, model: str, requests: List[GenRequest], display_name: str) -> str:
+    src = [{"contents": r.contents, "config": r.config} if r.config else {"contents": r.contents} for r in requests]
+    job = client.batches.create(model=model, src=src, config={"display_name": display_name})
+    return job.name
+
+
+# (상태 이름, 요청 순서대로의 결과 목록) — 아직 끝나지 않았으면 결과는 None
+def fetch_batch(client, name: str) -> Tuple[str, Optional[List[str]]]:
+    job = client.batches.get(name=name)
+    state = job.state.name if job.state is not None else "JOB_STATE_UNSPECIFIED"
+    if state not in BATCH_DONE_STATES:
+        return state, None
+
+    outs = []
+    for r in (job.dest.inlined_responses if job.dest else None) or []:
+        outs.append((r.response.text or "") if r.response is not None else "")
+    return state, outs